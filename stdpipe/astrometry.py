@@ -109,7 +109,48 @@ def spherical_distance(ra1, dec1, ra2, dec2):
     return np.rad2deg(2 * np.arcsin(np.sqrt(x * (z - y) + y)))
 
 
-def spherical_match(ra1, dec1, ra2, dec2, sr=1 / 3600):
+# Coordinates of the second set of points from the last spherical_match() call with cache=True,
+# along with the SkyCoord object holding its KD-tree, so that it may be re-used for repeated
+# matches against the same catalogue
+_spherical_match_cache = None
+
+
+def clear_spherical_match_cache():
+    """Release the catalogue coordinates and KD-tree cached by :func:`spherical_match` called with :code:`cache=True`"""
+    global _spherical_match_cache
+
+    _spherical_match_cache = None
+
+
+def _get_match_coords(ra, dec):
+    global _spherical_match_cache
+
+    if isinstance(ra, u.Quantity):
+        ra = ra.to_value(u.deg)
+    if isinstance(dec, u.Quantity):
+        dec = dec.to_value(u.deg)
+
+    ra = np.ascontiguousarray(ra, dtype=np.float64)
+    dec = np.ascontiguousarray(dec, dtype=np.float64)
+
+    cache = _spherical_match_cache
+
+    # Comparing the values is much cheaper than re-building the KD-tree
+    if (
+        cache is not None
+        and np.array_equal(cache[0], ra, equal_nan=True)
+        and np.array_equal(cache[1], dec, equal_nan=True)
+    ):
+        return cache[2]
+
+    coords = SkyCoord(ra, dec, unit='deg')
+    # Keep our own copies so that modifications of the inputs are noticed
+    _spherical_match_cache = (ra.copy(), dec.copy(), coords)
+
+    return coords
+
+
+def spherical_match(ra1, dec1, ra2, dec2, sr=1 / 3600, cache=False):
     """Positional match on the sphere for two lists of coordinates.
 
     Aimed to be a direct replacement for :func:`esutil.htm.HTM.match` method with :code:`maxmatch=0`.
@@ -119,6 +160,7 @@ def spherical_match(ra1, dec1, ra2, dec2, sr=1 / 3600):
     :param ra2: Second set of points RA
     :param dec2: Second set of points Dec
     :param sr: Maximal acceptable pair distance to be considered a match, in degrees
+    :param cache: If set, the second set of points and its KD-tree are kept in memory and re-used if the next call with :code:`cache=True` has the same second set. Use :func:`clear_spherical_match_cache` to release it.
     :returns: Two parallel sets of indices corresponding to matches from first and second lists, along with the pairwise distances in degrees
 
     """
@@ -129,8 +171,11 @@ def spherical_match(ra1, dec1, ra2, dec2, sr=1 / 3600):
     ra2 = np.atleast_1d(ra2)
     dec2 = np.atleast_1d(dec2)
 
+    # KD-tree is built for the second set, and optionally cached between the calls
+    coords2 = _get_match_coords(ra2, dec2) if cache else SkyCoord(ra2, dec2, unit='deg')
+
     idx1, idx2, dist, _ = search_around_sky(
-        SkyCoord(ra1, dec1, unit='deg'), SkyCoord(ra2, dec2, unit='deg'), sr * u.deg
+        SkyCoord(ra1, dec1, unit='deg'), coords2, sr * u.deg
     )
 
     dist = dist.deg  # convert to degrees
@@ -4,9 +4,14 @@ Routines for object detection and photometry.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os, shutil, tempfile, shlex
+import os, shutil, tempfile, shlex, subprocess
+import functools
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+from multiprocessing import shared_memory
+
 from astropy.wcs import WCS
 from astropy.io import fits
 from astropy.stats import mad_std, sigma_clipped_stats
@@ -24,6 +29,7 @@ from photutils.utils import calc_total_error
 
 import statsmodels.api as sm
 from scipy.optimize import minimize, least_squares, root_scalar
+from scipy.ndimage import median_filter, distance_transform_edt
 
 from . import astrometry
 
@@ -32,21 +38,39 @@ try:
 
     # Much faster dilation
     dilate = lambda image, mask: cv2.dilate(image.astype(np.uint8), mask).astype(bool)
+    # Rectangular structuring element that OpenCV may apply separably
+    dilate_kernel = lambda size: cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
 except:
-    from scipy.signal import fftconvolve
+    from scipy.ndimage import binary_dilation
+
+    # Proper binary dilation, with the origin of even-sized elements placed the same way as in OpenCV
+    dilate = lambda image, mask: binary_dilation(
+        image, structure=mask.astype(bool), origin=[_ % 2 - 1 for _ in mask.shape]
+    )
+    dilate_kernel = lambda size: np.ones([size, size])
 
-    dilate = lambda image, mask: fftconvolve(image, mask, mode='same') > 0.9
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from . import utils
 
+# Conversion factor from relative flux errors to magnitude errors, 2.5/ln(10)
+_MAGERR_SCALE = 2.5 / np.log(10)
 
+
+@functools.lru_cache(maxsize=32)
 def make_kernel(r0=1.0, ext=1.0):
-    x, y = np.mgrid[
+    # Open grids are broadcast against each other, so no full 2d coordinate arrays are built
+    y, x = np.ogrid[
         np.floor(-ext * r0) : np.ceil(ext * r0 + 1),
         np.floor(-ext * r0) : np.ceil(ext * r0 + 1),
     ]
-    r = np.hypot(x, y)
-    image = np.exp(-r ** 2 / 2 / r0 ** 2)
+    image = np.exp(-(x * x + y * y) / 2 / r0 ** 2)
+
+    # The kernel is cached and shared between the calls, so protect it from modification
+    image.setflags(write=False)
 
     return image
 
@@ -117,24 +141,36 @@ def get_objects_sep(
     else:
         kernel = None
 
+    own_image = False
+    if image.dtype != np.float32 or not image.flags.c_contiguous:
+        # SEP works natively with single precision, and it halves the memory traffic for all pixel loops.
+        # It also takes care of non-native byte order of FITS data
+        image = np.ascontiguousarray(image, dtype=np.float32)
+        own_image = True
+
     log("Preparing background mask")
 
     if mask is None:
         mask = np.zeros_like(image, dtype=bool)
 
-    mask_bg = np.zeros_like(mask)
-    mask_segm = np.zeros_like(mask)
+    # Mask to be used for the detection and measurement, possibly extended below
+    eff_mask = mask
 
     log("Building background map")
 
-    bg = sep.Background(image, mask=mask | mask_bg, bw=bg_size, bh=bg_size)
+    bg = sep.Background(image, mask=mask, bw=bg_size, bh=bg_size)
+    # Every call to bg.back() / bg.rms() re-builds the full-size map, so let's do it only once
+    back, rms = bg.back(), bg.rms()
+
+    # Our own copy of the image is not needed anymore and may be safely overwritten
+    image1 = image if own_image else np.empty_like(image, dtype=np.float32)
     if subtract_bg:
-        image1 = image - bg.back()
-    else:
-        image1 = image.copy()
+        np.subtract(image, back, out=image1)
+    elif image1 is not image:
+        np.copyto(image1, image)
 
     if err is None:
-        err = bg.rms()
+        err = rms
         err[~np.isfinite(err)] = 1e30
         err[err == 0] = 1e30
 
@@ -149,17 +185,22 @@ def get_objects_sep(
             err=err,
             thresh=thresh,
             minarea=minarea,
-            mask=mask | mask_bg,
+            mask=mask,
             filter_kernel=kernel,
             segmentation_map=True,
         )
 
         log("Dilating large objects")
 
-        mask_segm = np.isin(
-            segm, [_ + 1 for _, npix in enumerate(obj0['npix']) if npix > npix_large]
-        )
-        mask_segm = dilate(mask_segm, np.ones([10, 10]))
+        # Lookup table indexed by segment number, with zero for the background
+        is_large = np.empty(obj0['npix'].size + 1, dtype=bool)
+        is_large[0] = False
+        np.greater(obj0['npix'], npix_large, out=is_large[1:])
+
+        mask_segm = is_large[segm]
+        mask_segm = dilate(mask_segm, dilate_kernel(10))
+
+        eff_mask = mask | mask_segm
 
     log("Extracting final objects")
 
@@ -168,7 +209,7 @@ def get_objects_sep(
         err=err,
         thresh=thresh,
         minarea=minarea,
-        mask=mask | mask_bg | mask_segm,
+        mask=eff_mask,
         filter_kernel=kernel,
         segmentation_map=True,
         **kwargs
@@ -199,13 +240,13 @@ def get_objects_sep(
     # xwin,ywin,flag = sep.winpos(image1, obj0['x'], obj0['y'], 0.5, mask=mask)
     xwin, ywin = obj0['x'], obj0['y']
 
-    # Filter out objects too close to frame edges
-    idx = (
-        (np.round(xwin) > edge)
-        & (np.round(ywin) > edge)
-        & (np.round(xwin) < image.shape[1] - edge)
-        & (np.round(ywin) < image.shape[0] - edge)
-    )  # & (obj0['flag'] == 0)
+    # Filter out objects too close to frame edges, i.e. with rounded positions outside (edge, size - edge)
+    lo, hix, hiy = edge + 0.5, image.shape[1] - edge - 0.5, image.shape[0] - edge - 0.5
+    idx = xwin > lo
+    np.logical_and(idx, ywin > lo, out=idx)
+    np.logical_and(idx, xwin < hix, out=idx)
+    np.logical_and(idx, ywin < hiy, out=idx)
+    # idx &= obj0['flag'] == 0
 
     if minnthresh:
         idx &= obj0['tnpix'] >= minnthresh
@@ -219,27 +260,23 @@ def get_objects_sep(
         aper,
         err=err,
         gain=gain,
-        mask=mask | mask_bg | mask_segm,
+        mask=eff_mask,
         bkgann=bkgann,
     )
-    # For debug purposes, let's make also the same aperture photometry on the background map
-    bgflux, bgfluxerr, bgflag = sep.sum_circle(
-        bg.back(),
-        xwin[idx],
-        ywin[idx],
-        aper,
-        err=bg.rms(),
-        gain=gain,
-        mask=mask | mask_bg | mask_segm,
-    )
-
-    bgnorm = bgflux / np.pi / aper ** 2
+    # For debug purposes, let's also get the background level at object positions.
+    # Background map is smooth on the aperture scale, so its value at the center is
+    # equivalent to the mean inside the aperture
+    bgnorm = back[
+        np.clip(np.round(ywin[idx]).astype(np.intp), 0, image.shape[0] - 1),
+        np.clip(np.round(xwin[idx]).astype(np.intp), 0, image.shape[1] - 1),
+    ]
 
     # Fluxes to magnitudes
-    mag, magerr = np.zeros_like(flux), np.zeros_like(flux)
-    mag[flux > 0] = -2.5 * np.log10(flux[flux > 0])
+    pos = flux > 0
+    safe = np.where(pos, flux, 1.0)
+    mag = np.where(pos, -2.5 * np.log10(safe), 0.0)
     # magerr[flux>0] = 2.5*np.log10(1.0 + fluxerr[flux>0]/flux[flux>0])
-    magerr[flux > 0] = 2.5 / np.log(10) * fluxerr[flux > 0] / flux[flux > 0]
+    magerr = np.where(pos, _MAGERR_SCALE * (fluxerr / safe), 0.0)
 
     # FWHM estimation - FWHM=HFD for Gaussian
     fwhm = (
@@ -263,50 +300,207 @@ def get_objects_sep(
         # If header is provided, we may build WCS from it
         wcs = WCS(header)
 
+    # Indices of objects passing all the cuts, and their rows from the detection table
+    sel = np.flatnonzero(idx)[fidx]
+    sub = obj0[sel]
+
+    # Convert variances to rms in place, as `sub` is already a copy
+    np.sqrt(sub['errx2'], out=sub['errx2'])
+    np.sqrt(sub['erry2'], out=sub['erry2'])
+
+    x, y = xwin[sel], ywin[sel]
+
     if wcs is not None:
         # If WCS is provided we may convert x,y to ra,dec
-        ra, dec = wcs.all_pix2world(obj0['x'][idx], obj0['y'][idx], 0)
+        ra, dec = wcs.all_pix2world(x, y, 0)
     else:
-        ra, dec = np.zeros_like(obj0['x'][idx]), np.zeros_like(obj0['y'][idx])
+        ra, dec = np.zeros_like(x), np.zeros_like(y)
 
     if verbose:
         log("All done")
 
     obj = Table(
         {
-            'x': xwin[idx][fidx],
-            'y': ywin[idx][fidx],
-            'xerr': np.sqrt(obj0['errx2'][idx][fidx]),
-            'yerr': np.sqrt(obj0['erry2'][idx][fidx]),
+            'x': x,
+            'y': y,
+            'xerr': sub['errx2'],
+            'yerr': sub['erry2'],
             'flux': flux[fidx],
             'fluxerr': fluxerr[fidx],
             'mag': mag[fidx],
             'magerr': magerr[fidx],
-            'flags': obj0['flag'][idx][fidx] | flag[fidx],
-            'ra': ra[fidx],
-            'dec': dec[fidx],
+            'flags': sub['flag'] | flag[fidx],
+            'ra': ra,
+            'dec': dec,
             'bg': bgnorm[fidx],
             'fwhm': fwhm[fidx],
-            'a': obj0['a'][idx][fidx],
-            'b': obj0['b'][idx][fidx],
-            'theta': obj0['theta'][idx][fidx],
+            'a': sub['a'],
+            'b': sub['b'],
+            'theta': sub['theta'],
         }
     )
 
     obj.meta['aper'] = aper
     obj.meta['bkgann'] = bkgann
 
+    if get_segmentation:
+        obj['number'] = sel + 1  # Running object number, as used in segmentation map
+
     obj.sort('flux', reverse=True)
 
     if get_segmentation:
-        number = np.arange(len(obj0['x'])) + 1 # Running object number
-        obj['number'] = number[idx][fidx]
-
         return obj, segm
     else:
         return obj
 
 
+def _share_array(array):
+    """Copy the array into newly created shared memory block, and return the block along with the description needed to access it from another process"""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _get_objects_sep_shared(shared, kwargs):
+    """Worker for :func:`get_objects_sep_batch` that runs :func:`get_objects_sep` on the arrays from shared memory blocks"""
+    blocks = {}
+    try:
+        for key, (name, shape, dtype) in shared.items():
+            blocks[key] = shared_memory.SharedMemory(name=name)
+            kwargs[key] = np.ndarray(shape, dtype=dtype, buffer=blocks[key].buf)
+
+        return get_objects_sep(**kwargs)
+    finally:
+        # Views into shared memory have to be released before closing it
+        kwargs.clear()
+        for shm in blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                # Still referenced from the traceback, will be released on exit
+                pass
+
+
+def get_objects_sep_batch(
+    images,
+    masks=None,
+    errs=None,
+    headers=None,
+    nprocs=None,
+    mp_context=None,
+    verbose=True,
+    **kwargs
+):
+    """Run :func:`~stdpipe.photometry.get_objects_sep` on a sequence of images in parallel processes.
+
+    The images (and their masks and noise maps, if provided) are passed to the worker processes through shared memory as single precision copies, so that they are not pickled. Only as many frames as there are worker processes are kept in shared memory at once, and the arrays that do not fit into :file:`/dev/shm` are pickled instead.
+
+    :param images: List of input images as NumPy arrays
+    :param masks: List of image masks (one per image, or None), optional
+    :param errs: List of image noise maps (one per image, or None), optional
+    :param headers: List of image headers (one per image, or None), optional
+    :param nprocs: Number of worker processes. If not set, half of available CPU cores will be used
+    :param mp_context: Multiprocessing start method (e.g. `spawn` or `forkserver`) for worker processes, optional. Default one is usually `fork` on Linux, which may hang if the current process already runs threads that are not fork-safe (e.g. Numba TBB threading layer after :code:`get_background(method='numba')`)
+    :param verbose: Whether to show verbose messages during the run of the function or not. May be either boolean, or a `print`-like function.
+    :param \**kwargs: The rest of keyword arguments will be directly passed to :func:`~stdpipe.photometry.get_objects_sep`
+    :returns: List of results of :func:`~stdpipe.photometry.get_objects_sep` calls for every image, in the same order
+    """
+
+    # Simple wrapper around print for logging in verbose mode only
+    log = (
+        (verbose if callable(verbose) else print)
+        if verbose
+        else lambda *args, **kwargs: None
+    )
+
+    if nprocs is None:
+        nprocs = max(1, (os.cpu_count() or 1) // 2)
+    nprocs = max(1, min(nprocs, len(images)))
+
+    log("Processing %d images in %d processes" % (len(images), nprocs))
+
+    # Workers should stay silent
+    kwargs['verbose'] = False
+
+    def submit(executor, i):
+        shared = {}
+        frame_blocks = []
+        frame_kwargs = dict(kwargs)
+        if headers is not None:
+            frame_kwargs['header'] = headers[i]
+
+        for key, arrays in [('image', images), ('mask', masks), ('err', errs)]:
+            if arrays is not None and arrays[i] is not None:
+                array = arrays[i]
+                if key == 'mask':
+                    array = np.ascontiguousarray(array)
+                else:
+                    # Workers would convert it to single precision anyway
+                    array = np.ascontiguousarray(array, dtype=np.float32)
+
+                # Writing to overcommitted shared memory kills the process with SIGBUS
+                # instead of raising an error, so pickle the arrays not fitting into /dev/shm
+                if (
+                    os.path.isdir('/dev/shm')
+                    and shutil.disk_usage('/dev/shm').free < 2 * array.nbytes
+                ):
+                    log(
+                        "Not enough room in /dev/shm, pickling the %s for image %d"
+                        % (key, i)
+                    )
+                    frame_kwargs[key] = array
+                else:
+                    shm, shared[key] = _share_array(array)
+                    frame_blocks.append(shm)
+
+        blocks[i] = frame_blocks
+
+        return executor.submit(_get_objects_sep_shared, shared, frame_kwargs)
+
+    blocks = [[] for _ in images]
+    results = [None] * len(images)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=nprocs,
+            mp_context=multiprocessing.get_context(mp_context) if mp_context else None,
+        ) as executor:
+            # Keep only as many frames in flight (and in shared memory) as there are
+            # worker processes, and submit the next one when any of them completes
+            pending = {}
+            nsubmitted = min(nprocs, len(images))
+            for i in range(nsubmitted):
+                pending[submit(executor, i)] = i
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    i = pending.pop(future)
+                    result = results[i] = future.result()
+
+                    # Release shared memory as soon as the frame is processed
+                    for shm in blocks[i]:
+                        shm.close()
+                        shm.unlink()
+                    blocks[i] = []
+
+                    obj = result[0] if isinstance(result, tuple) else result
+                    log("Image %d: %d objects" % (i, len(obj)))
+
+                    if nsubmitted < len(images):
+                        pending[submit(executor, nsubmitted)] = nsubmitted
+                        nsubmitted += 1
+    finally:
+        for frame_blocks in blocks:
+            for shm in frame_blocks:
+                shm.close()
+                shm.unlink()
+
+    return results
+
+
 def get_objects_sextractor(
     image,
     header=None,
@@ -363,7 +557,7 @@ def get_objects_sextractor(
     :param psf: Path to PSFEx-made PSF model file to be used for PSF photometry. If provided, a set of PSF-measured parameters (`FLUX_PSF`, `MAG_PSF` etc) are added to detected objects. Optional
     :param catfile: If provided, output SExtractor catalogue file will be copied to this location, to be reused by external codes. Optional.
     :param _workdir: If specified, all temporary files will be created in this directory, and will be kept intact after running SExtractor. May be used for debugging exact inputs and outputs of the executable. Optional
-    :param _tmpdir: If specified, all temporary files will be created in a dedicated directory (that will be deleted after running the executable) inside this path.
+    :param _tmpdir: If specified, all temporary files will be created in a dedicated directory (that will be deleted after running the executable) inside this path. If not, memory-backed :file:`/dev/shm` is used when available and large enough, or system-wide temporary directory otherwise.
     :param _exe: Full path to SExtractor executable. If not provided, the code tries to locate it automatically in your :envvar:`PATH`.
     :param verbose: Whether to show verbose messages during the run of the function or not. May be either boolean, or a `print`-like function.
     :returns: Either the astropy.table.Table object with detected objects, or a list with table of objects (first element) and checkimages (consecutive elements), if checkimages are requested.
@@ -396,6 +590,13 @@ def get_objects_sextractor(
     # else:
     #     log("Using SExtractor binary at", binname)
 
+    if _workdir is None and _tmpdir is None and os.path.isdir('/dev/shm'):
+        # Prefer memory-backed filesystem for the temporary files if it has enough room for the image,
+        # noise map, flags and checkimages
+        nbytes = np.size(image) * (8 + 8 + 2 + 4 * len(checkimages))
+        if shutil.disk_usage('/dev/shm').free > 2 * nbytes:
+            _tmpdir = '/dev/shm'
+
     workdir = (
         _workdir
         if _workdir is not None
@@ -417,7 +618,7 @@ def get_objects_sextractor(
         imagename = image
     else:
         imagename = os.path.join(workdir, 'image.fits')
-        fits.writeto(imagename, image, header, overwrite=True)
+        fits.writeto(imagename, image, header, overwrite=True, output_verify='ignore')
 
     # Dummy config filename, to prevent loading from current dir
     confname = os.path.join(workdir, 'empty.conf')
@@ -444,12 +645,12 @@ def get_objects_sextractor(
         err[err == 0] = 1e30
 
         errname = os.path.join(workdir, 'errors.fits')
-        fits.writeto(errname, err, overwrite=True)
+        fits.writeto(errname, err, overwrite=True, output_verify='ignore')
         opts['WEIGHT_IMAGE'] = errname
         opts['WEIGHT_TYPE'] = 'MAP_RMS'
 
     flagsname = os.path.join(workdir, 'flags.fits')
-    fits.writeto(flagsname, mask.astype(np.int16), overwrite=True)
+    fits.writeto(flagsname, mask.astype(np.int16), overwrite=True, output_verify='ignore')
     opts['FLAG_IMAGE'] = flagsname
 
     if np.isscalar(aper):
@@ -527,21 +728,18 @@ def get_objects_sextractor(
     opts.update(extra)
 
     # Build the command line
-    cmd = (
-        binname
-        + ' '
-        + shlex.quote(imagename)
-        + ' '
-        + utils.format_astromatic_opts(opts)
-    )
-    if not verbose:
-        cmd += ' > /dev/null 2>/dev/null'
+    argv = [binname, imagename] + utils.format_astromatic_argv(opts)
     log('Will run SExtractor like that:')
-    log(cmd)
+    log(' '.join([shlex.quote(_) for _ in argv]))
 
     # Run the command!
 
-    res = os.system(cmd)
+    res = subprocess.run(
+        argv,
+        stdout=None if verbose else subprocess.DEVNULL,
+        stderr=None if verbose else subprocess.DEVNULL,
+        check=False,
+    ).returncode
 
     if res == 0 and os.path.exists(catname):
         log('SExtractor run succeeded')
@@ -679,6 +877,70 @@ def make_series(mul=1.0, x=1.0, y=1.0, order=1, sum=False, zero=True):
         return res
 
 
+def _series_len(order=1, zero=True):
+    """Number of terms in the polynomial series of given order, as produced by :func:`make_series`"""
+    return (order + 1) * (order + 2) // 2 - (0 if zero else 1)
+
+
+def _fill_series(x, y, mul, order, out, col0=0):
+    # Fills the columns of `out` starting from `col0` with the same terms as make_series(),
+    # computing every monomial from the one of previous degree instead of raising to powers.
+    # Term x**(i-j)*y**j is stored at column col0 + i*(i+1)/2 + j
+    out[:, col0] = mul
+
+    for i in range(1, order + 1):
+        c0, c1 = col0 + i * (i - 1) // 2, col0 + i * (i + 1) // 2
+
+        np.multiply(out[:, c0 : c0 + i], x[:, None], out=out[:, c1 : c1 + i])
+        np.multiply(out[:, c0 + i - 1], y, out=out[:, c1 + i])
+
+
+def make_design_matrix(x, y, terms):
+    """Build the design matrix for the polynomial model consisting of several series.
+
+    Every element of `terms` is a `(mul, order)` tuple defining the set of columns equivalent to :code:`make_series(mul, x, y, order=order)`, and the columns for all the series are concatenated in the same order, so that the result is equivalent to :code:`np.vstack(make_series(...) + make_series(...) + ...).T`
+
+    :param x: Array of `x` values
+    :param y: Array of `y` values
+    :param terms: List of `(mul, order)` tuples, where `mul` is either scalar or array of the same length as `x` and `y`
+    :returns: Design matrix as a C-contiguous array of shape `(N, Nterms)`
+    """
+    x = np.ascontiguousarray(np.atleast_1d(x), dtype=np.double)
+    y = np.ascontiguousarray(np.atleast_1d(y), dtype=np.double)
+
+    X = np.empty((x.shape[0], sum(_series_len(order) for _, order in terms)))
+
+    col = 0
+    for mul, order in terms:
+        _fill_series(x, y, mul, order, X, col)
+        col += _series_len(order)
+
+    return X
+
+
+def _wls_fit(y, X, w):
+    """Weighted least squares fit of `y` over the regressors in `X`, with `w` being the square roots of the weights (i.e. inverse errors).
+
+    Equivalent to :code:`sm.WLS(y, X, weights=w**2).fit()` but without statsmodels overhead.
+    Returns the tuple of fitted parameters, their covariance matrix, and the scale (reduced chi-squared) of the fit.
+    """
+    Xw = X * w[:, None]
+    yw = y * w
+
+    # Pseudo-inverse through SVD, as the regressors may be poorly conditioned
+    U, S, Vt = np.linalg.svd(Xw, full_matrices=False)
+    good = S > S.max() * max(Xw.shape) * np.finfo(S.dtype).eps
+    Sinv = np.where(good, 1 / np.where(good, S, 1), 0)
+
+    params = Vt.T.dot(Sinv * U.T.dot(yw))
+
+    resid = yw - Xw.dot(params)
+    scale = resid.dot(resid) / (len(yw) - np.sum(good))
+    cov = (Vt.T * Sinv ** 2).dot(Vt) * scale
+
+    return params, cov, scale
+
+
 def get_intrinsic_scatter(y, yerr, min=0, max=None):
     def log_likelihood(theta, y, yerr):
         a, b, c = theta
@@ -724,6 +986,7 @@ def match(
     robust=True,
     scale_noise=False,
     use_color=True,
+    cache_catalog=False,
 ):
     """Low-level photometric matching routine.
 
@@ -754,6 +1017,7 @@ def match(
     :param robust: Whether to use robust least squares fitting routine instead of weighted least squares
     :param scale_noise: Whether to re-scale the noise model (object and catalogue magnitude errors) to match actual scatter of the data points or not. Intrinsic scatter term is not being scaled this way.
     :param use_color: Whether to use catalogue color for deriving the color term.
+    :param cache_catalog: Whether to keep the catalogue coordinates and their KD-tree in memory so that subsequent calls with the same catalogue (e.g. for a sequence of frames of the same field) skip re-building it. The cache holds a single catalogue and stays alive until it is replaced by another one, or released by the caller with :func:`stdpipe.astrometry.clear_spherical_match_cache`.
     :returns: The dictionary with photometric results, as described below.
 
     The results of photometric matching are returned in a dictionary with the following fields:
@@ -789,7 +1053,13 @@ def match(
         else lambda *args, **kwargs: None
     )
 
-    oidx, cidx, dist = astrometry.spherical_match(obj_ra, obj_dec, cat_ra, cat_dec, sr)
+    # Double precision contiguous coordinates, so that they are not converted again while matching
+    obj_ra = np.ascontiguousarray(obj_ra, dtype=np.float64)
+    obj_dec = np.ascontiguousarray(obj_dec, dtype=np.float64)
+
+    oidx, cidx, dist = astrometry.spherical_match(
+        obj_ra, obj_dec, cat_ra, cat_dec, sr, cache=cache_catalog
+    )
 
     log(
         len(dist),
@@ -823,12 +1093,12 @@ def match(
         x, y = np.zeros_like(omag), np.zeros_like(omag)
 
     # Regressor
-    X = make_series(1.0, x, y, order=spatial_order)
+    terms = [(1.0, spatial_order)]
     log('Fitting the model with spatial_order =', spatial_order)
 
     if bg_order is not None:
         # Spatially varying additive flux component, linearized in magnitudes
-        X += make_series(-2.5 / np.log(10) / 10 ** (-0.4 * omag), x, y, order=bg_order)
+        terms.append((-2.5 / np.log(10) / 10 ** (-0.4 * omag), bg_order))
         log('Adjusting background level using polynomial with bg_order =', bg_order)
 
     if robust:
@@ -839,14 +1109,13 @@ def match(
     if cat_color is not None:
         ccolor = np.ma.filled(cat_color[cidx], fill_value=np.nan)
         if use_color:
-            X += make_series(ccolor, x, y, order=0)
+            terms.append((ccolor, 0))
             log('Using color term')
     else:
         ccolor = np.zeros_like(cmag)
 
-    Nparams = len(X)  # Number of parameters to be fitted
-
-    X = np.vstack(X).T
+    X = make_design_matrix(x, y, terms)
+    Nparams = X.shape[1]  # Number of parameters to be fitted
     zero = cmag - omag  # We will build a model for this definition of zero point
     zero_err = np.hypot(omag_err, cmag_err)
     # weights = 1.0/zero_err**2
@@ -872,6 +1141,11 @@ def match(
     intrinsic_rms = 0
     scale_err = 1
     total_err = zero_err
+    params = None
+
+    # Buffers for the residuals and normalized residuals, re-used between iterations
+    resid = np.empty_like(zero)
+    resid_norm = np.empty_like(zero)
 
     for iter in range(niter):
         if np.sum(idx) < Nparams + 1:
@@ -882,27 +1156,31 @@ def match(
             return None
 
         if robust:
-            # Rescale the arguments with weights
-            C = sm.RLM(zero[idx] / total_err[idx], (X[idx].T / total_err[idx]).T).fit()
+            # Rescale the arguments with weights, and start from the previous iteration solution
+            C = sm.RLM(zero[idx] / total_err[idx], (X[idx].T / total_err[idx]).T).fit(
+                start_params=params
+            )
+            params, cov, scale = C.params, C.cov_params(), C.scale
         else:
-            C = sm.WLS(zero[idx], X[idx], weights=1 / total_err[idx] ** 2).fit()
+            params, cov, scale = _wls_fit(zero[idx], X[idx], 1 / total_err[idx])
 
-        zero_model = np.sum(X * C.params, axis=1)
-        zero_model_err = np.sqrt(C.cov_params(X).diagonal())
+        zero_model = X.dot(params)
+        np.subtract(zero, zero_model, out=resid)
+        # Diagonal of X*cov*X^T, without building the full matrix
+        zero_model_err = np.sqrt(np.einsum('ij,jk,ik->i', X, cov, X))
 
         intrinsic_rms = (
-            get_intrinsic_scatter(
-                (zero - zero_model)[idx], total_err[idx], max=max_intrinsic_rms
-            )
+            get_intrinsic_scatter(resid[idx], total_err[idx], max=max_intrinsic_rms)
             if max_intrinsic_rms > 0
             else 0
         )
 
-        scale_err = 1 if not scale_noise else np.sqrt(C.scale)  # rms
+        scale_err = 1 if not scale_noise else np.sqrt(scale)  # rms
         total_err = np.hypot(zero_err * scale_err, intrinsic_rms)
+        np.divide(resid, total_err, out=resid_norm)
 
         if threshold:
-            idx1 = np.abs((zero - zero_model) / total_err)[idx] < threshold
+            idx1 = np.abs(resid_norm[idx]) < threshold
         else:
             idx1 = np.ones_like(idx[idx])
 
@@ -914,12 +1192,12 @@ def match(
             '/',
             len(idx),
             '- rms',
-            '%.2f' % np.std((zero - zero_model)[idx0]),
-            '%.2f' % np.std((zero - zero_model)[idx]),
+            '%.2f' % np.std(resid[idx0]),
+            '%.2f' % np.std(resid[idx]),
             '- normed',
-            '%.2f' % np.std((zero - zero_model)[idx] / zero_err[idx]),
-            '%.2f' % np.std((zero - zero_model)[idx] / total_err[idx]),
-            '- scale %.2f %.2f' % (np.sqrt(C.scale), scale_err),
+            '%.2f' % np.std(resid[idx] / zero_err[idx]),
+            '%.2f' % np.std(resid_norm[idx]),
+            '- scale %.2f %.2f' % (np.sqrt(scale), scale_err),
             '- rms',
             '%.2f' % intrinsic_rms,
         )
@@ -941,31 +1219,29 @@ def match(
         else:
             x, y = np.zeros_like(omag), np.zeros_like(omag)
 
-        X = make_series(1.0, x, y, order=spatial_order)
+        terms = [(1.0, spatial_order)]
 
         if bg_order is not None and mag is not None:
-            X += make_series(
-                -2.5 / np.log(10) / 10 ** (-0.4 * mag), x, y, order=bg_order
-            )
+            terms.append((-2.5 / np.log(10) / 10 ** (-0.4 * mag), bg_order))
 
-        X = np.vstack(X).T
+        X = make_design_matrix(x, y, terms)
 
         if get_err:
             # It follows the implementation from https://github.com/statsmodels/statsmodels/blob/081fc6e85868308aa7489ae1b23f6e72f5662799/statsmodels/base/model.py#L1383
             # FIXME: crashes on large numbers of stars?..
-            # err = np.sqrt(np.dot(X, np.dot(C.cov_params()[0:X.shape[1], 0:X.shape[1]], np.transpose(X))).diagonal())
+            # err = np.sqrt(np.dot(X, np.dot(cov[0:X.shape[1], 0:X.shape[1]], np.transpose(X))).diagonal())
             err = np.zeros_like(x)
             if add_intrinsic_rms:
                 err = np.hypot(err, intrinsic_rms)
             return err
         else:
-            return np.sum(X * C.params[0 : X.shape[1]], axis=1)
+            return X.dot(params[0 : X.shape[1]])
 
     if cat_color is not None and use_color:
-        X = make_series(order=spatial_order)
+        Nspatial = _series_len(spatial_order)
         if bg_order is not None:
-            X += make_series(order=bg_order)
-        color_term = C.params[len(X) :][0]
+            Nspatial += _series_len(bg_order)
+        color_term = params[Nspatial:][0]
         log('Color term is %.2f' % color_term)
     else:
         color_term = None
@@ -985,8 +1261,8 @@ def match(
         'zero_model': zero_model,
         'zero_model_err': zero_model_err,
         'zero_fn': zero_fn,
-        'params': C.params,
-        'error_scale': np.sqrt(C.scale),
+        'params': params,
+        'error_scale': np.sqrt(scale),
         'intrinsic_rms': intrinsic_rms,
         'obj_zero': zero_fn(obj_x, obj_y, mag=obj_mag),
         'ox': ox,
@@ -997,11 +1273,123 @@ def match(
     }
 
 
+if numba is not None:
+
+    def _clipped_stats_kernel(values, mean, std):
+        # Iterative 3-sigma clipping of the values, NaNs are ignored
+        lo, hi = -np.inf, np.inf
+        mean[0], std[0] = np.nan, np.nan
+        nprev = -1
+
+        for _ in range(5):
+            n, s1, s2 = 0, 0.0, 0.0
+            for v in values:
+                if v >= lo and v <= hi:
+                    n += 1
+                    s1 += v
+                    s2 += v * v
+
+            if n == 0 or n == nprev:
+                break
+
+            m = s1 / n
+            sd = np.sqrt(max(s2 / n - m * m, 0.0))
+            mean[0], std[0] = m, sd
+            lo, hi = m - 3.0 * sd, m + 3.0 * sd
+            nprev = n
+
+    @functools.lru_cache(maxsize=None)
+    def _get_clipped_stats_numba():
+        # Compiled on first use, as parallel target starts the threads that would not survive fork()
+        return numba.guvectorize(
+            ['void(float32[:], float32[:], float32[:])'],
+            '(n)->(),()',
+            nopython=True,
+            target='parallel',
+        )(_clipped_stats_kernel)
+
+
+def _interpolation_matrix(centers, n):
+    """Matrix of weights for linear interpolation (and extrapolation) from the values at `centers` to all positions `0..n-1`"""
+    W = np.zeros((n, len(centers)))
+
+    if len(centers) < 2:
+        W[:] = 1
+        return W
+
+    pos = np.arange(n)
+    i = np.clip(np.searchsorted(centers, pos) - 1, 0, len(centers) - 2)
+    t = (pos - centers[i]) / (centers[i + 1] - centers[i])
+
+    W[pos, i] = 1 - t
+    W[pos, i + 1] = t
+
+    return W
+
+
+def _get_background_numba(image, mask=None, size=128, filter_size=3):
+    """Background and background rms maps from sigma-clipped statistics in `size` x `size` tiles, median filtered and bilinearly interpolated between tile centers to full resolution"""
+    if numba is None:
+        raise RuntimeError('Numba is required for this background estimation method')
+
+    ny, nx = -(-image.shape[0] // size), -(-image.shape[1] // size)
+
+    # Pad the image to the whole number of tiles, with NaNs marking the pixels to be ignored
+    tiles = np.full((ny * size, nx * size), np.nan, dtype=np.float32)
+    tiles[: image.shape[0], : image.shape[1]] = image
+    if mask is not None:
+        tiles[: image.shape[0], : image.shape[1]][mask] = np.nan
+
+    tiles = tiles.reshape(ny, size, nx, size).transpose(0, 2, 1, 3).reshape(ny, nx, -1)
+
+    # Tile centers, taking into account that the outer tiles may be incomplete
+    Wy, Wx = [
+        _interpolation_matrix(
+            (np.arange(n) * size + np.minimum(np.arange(1, n + 1) * size, N) - 1) / 2, N
+        )
+        for n, N in [(ny, image.shape[0]), (nx, image.shape[1])]
+    ]
+
+    result = []
+    for grid in _get_clipped_stats_numba()(tiles):
+        # Fill fully masked tiles from the nearest good ones
+        bad = ~np.isfinite(grid)
+        if np.all(bad):
+            grid[:] = 0
+        elif np.any(bad):
+            grid = grid[
+                tuple(distance_transform_edt(bad, return_distances=False, return_indices=True))
+            ]
+
+        if filter_size and filter_size > 1:
+            # Suppress outlying tiles like SEP does. Odd reflection keeps linear gradients intact near the edges
+            w = filter_size // 2
+            grid = np.pad(grid, w, mode='reflect', reflect_type='odd')
+            grid = median_filter(grid, size=filter_size)[w:-w, w:-w]
+
+        # Bilinear interpolation between the tile centers, done separably along both axes
+        result.append(Wy.dot(grid).dot(Wx.T).astype(np.float32))
+
+    return result
+
+
 def get_background(image, mask=None, method='sep', size=128, get_rms=False, **kwargs):
+    """Estimate the background (and optionally the background rms) map for the image.
+
+    :param image: Input image as a NumPy array
+    :param mask: Image mask as a boolean array (True values will be masked), optional
+    :param method: Background estimation method - `sep` for `SEP <https://github.com/kbarbary/sep>`_, `numba` for sigma-clipped statistics in the tiles computed in parallel using `Numba <https://numba.pydata.org>`_, or `photutils` for :class:`photutils.background.Background2D`
+    :param size: Background grid size in pixels
+    :param get_rms: Whether to also return the background rms map
+    :param \**kwargs: The rest of keyword arguments will be passed to background estimation routine
+    :returns: Background map, or the tuple of background and background rms maps if :code:`get_rms=True`
+    """
     if method == 'sep':
         bg = sep.Background(image, mask=mask, bw=size, bh=size, **kwargs)
 
         back, backrms = bg.back(), bg.rms()
+    elif method == 'numba':
+        back, backrms = _get_background_numba(image, mask=mask, size=size, **kwargs)
     else:  # photutils
         bg = photutils.Background2D(image, size, mask=mask, **kwargs)
         back, backrms = bg.background, bg.background_rms
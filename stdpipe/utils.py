@@ -210,24 +210,28 @@ def format_astromatic_opts(opts):
     Auxiliary function to format dictionary of options into Astromatic compatible command-line string.
     Booleans are converted to Y/N, arrays to comma separated lists, strings are quoted when necessary
     """
+    return ' '.join([shlex.quote(_) for _ in format_astromatic_argv(opts)])
+
+
+def format_astromatic_argv(opts):
+    """
+    Auxiliary function to format dictionary of options into the list of Astromatic compatible command-line arguments, suitable for passing to :func:`subprocess.run` without the shell.
+    Booleans are converted to Y/N, arrays to comma separated lists
+    """
     result = []
 
     for key in opts.keys():
         if opts[key] is None:
             pass
         elif type(opts[key]) == bool:
-            result.append('-%s %s' % (key, 'Y' if opts[key] else 'N'))
+            result += ['-%s' % key, 'Y' if opts[key] else 'N']
         else:
             value = opts[key]
 
-            if type(value) == str:
-                value = shlex.quote(value)
-            elif hasattr(value, '__len__'):
+            if type(value) != str and hasattr(value, '__len__'):
                 value = ','.join([str(_) for _ in value])
 
-            result.append('-%s %s' % (key, value))
-
-    result = ' '.join(result)
+            result += ['-%s' % key, str(value)]
 
     return result
 